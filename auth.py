@@ -3,23 +3,44 @@ from fastapi.security import OAuth2PasswordBearer
 from jose import JWTError, jwt
 from passlib.context import CryptContext
 from datetime import datetime, timedelta
-from sqlalchemy.orm import Session
+from typing import NamedTuple
+from cachetools import TLRUCache
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from database import SessionLocal, User
 import os
+import time
 
 SECRET_KEY = os.getenv("SECRET_KEY", "your-secret-key")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
+# Resolved users are reused for at most this many seconds, and never past token expiry
+USER_CACHE_TTL = 300
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# New hashes use argon2; existing bcrypt hashes still verify and are upgraded on login
+pwd_context = CryptContext(
+    schemes=["argon2", "bcrypt"],
+    deprecated="auto",
+    argon2__time_cost=2,
+    argon2__memory_cost=64 * 1024,
+    argon2__parallelism=2,
+)
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
-def get_db():
-    db = SessionLocal()
-    try:
+class CurrentUser(NamedTuple):
+    id: int
+    username: str
+    expires: float
+
+_user_cache = TLRUCache(
+    maxsize=10_000,
+    ttu=lambda _cookie, user, now: min(now + USER_CACHE_TTL, user.expires),
+    timer=time.time,
+)
+
+async def get_db():
+    async with SessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
 def verify_password(plain_password, hashed_password):
     return pwd_context.verify(plain_password, hashed_password)
@@ -27,6 +48,9 @@ def verify_password(plain_password, hashed_password):
 def get_password_hash(password):
     return pwd_context.hash(password)
 
+def password_needs_rehash(hashed_password):
+    return pwd_context.needs_update(hashed_password)
+
 def create_access_token(data: dict, expires_delta: timedelta | None = None):
     to_encode = data.copy()
     if expires_delta:
@@ -37,7 +61,7 @@ def create_access_token(data: dict, expires_delta: timedelta | None = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+async def get_current_user(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_db)):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -50,7 +74,22 @@ def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(
             raise credentials_exception
     except JWTError:
         raise credentials_exception
-    user = db.query(User).filter(User.username == username).first()
+    result = await db.execute(select(User).where(User.username == username))
+    user = result.scalar_one_or_none()
     if user is None:
         raise credentials_exception
     return user
+
+async def resolve_user(cookie: str, db: AsyncSession) -> CurrentUser:
+    """Resolve the ``access_token`` cookie to a user, caching the result by cookie value."""
+    user = _user_cache.get(cookie)
+    if user is not None:
+        return user
+    token = cookie.split(" ")[1]
+    db_user = await get_current_user(token, db)
+    user = CurrentUser(db_user.id, db_user.username, jwt.get_unverified_claims(token)["exp"])
+    _user_cache[cookie] = user
+    return user
+
+def forget_user(cookie: str):
+    _user_cache.pop(cookie, None)
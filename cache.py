@@ -0,0 +1,57 @@
+import os
+import time
+import logging
+
+import orjson
+import redis.asyncio as redis
+from cachetools import TTLCache
+
+REDIS_URL = os.getenv("REDIS_URL")
+# Entries outlive their freshness so they can still be served when NASA is unreachable
+STALE_TTL = 7 * 24 * 3600
+
+logger = logging.getLogger(__name__)
+
+class ResponseCache:
+    """Cache for NASA APOD payloads.
+
+    Backed by Redis when a URL is given (run the server with
+    ``maxmemory-policy allkeys-lfu``), otherwise by an in-process TTLCache,
+    which is enough for single-worker deploys.
+    """
+
+    def __init__(self, url: str | None = None, maxsize: int = 1024):
+        self.redis = redis.from_url(url) if url else None
+        self.local = TTLCache(maxsize=maxsize, ttl=STALE_TTL)
+
+    async def get(self, key: str):
+        if self.redis is None:
+            return self.local.get(key)
+        try:
+            raw = await self.redis.get(key)
+        except redis.RedisError as e:
+            logger.warning(f"Redis read failed for {key}: {e}")
+            return None
+        return orjson.loads(raw) if raw else None
+
+    async def set(self, key: str, payload: dict, ttl: int, etag: str | None = None, last_modified: str | None = None):
+        record = {
+            "payload": payload,
+            "expires": time.time() + ttl,
+            "etag": etag,
+            "last_modified": last_modified,
+        }
+        if self.redis is None:
+            self.local[key] = record
+            return
+        try:
+            await self.redis.set(key, orjson.dumps(record), ex=STALE_TTL)
+        except redis.RedisError as e:
+            logger.warning(f"Redis write failed for {key}: {e}")
+
+    async def close(self):
+        if self.redis is not None:
+            await self.redis.aclose()
+
+def is_fresh(record: dict | None) -> bool:
+    return record is not None and record["expires"] > time.time()
@@ -1,15 +1,73 @@
-from sqlalchemy import create_engine, Column, Integer, String, ForeignKey, Date
+from sqlalchemy import event, inspect, text, Column, Integer, String, ForeignKey, Date, JSON, UniqueConstraint
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.engine import URL, make_url
+from sqlalchemy.exc import DatabaseError
+from sqlalchemy.orm import relationship
 
 import os
 
-DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./data/test.db")
+# Async drivers for the plain URLs existing deployments were configured with
+ASYNC_DRIVERS = {
+    "sqlite": "sqlite+aiosqlite",
+    "postgres": "postgresql+asyncpg",
+    "postgresql": "postgresql+asyncpg",
+}
 
-engine = create_engine(DATABASE_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+def to_async_url(url: str) -> URL:
+    """Parse a database URL, swapping a sync driver for its asyncio counterpart."""
+    parsed = make_url(url)
+    if parsed.drivername in ASYNC_DRIVERS:
+        parsed = parsed.set(drivername=ASYNC_DRIVERS[parsed.drivername])
+    return parsed
+
+DATABASE_URL = to_async_url(os.getenv("DATABASE_URL", "sqlite+aiosqlite:///./data/test.db"))
+
+if DATABASE_URL.get_backend_name() == "sqlite":
+    engine = create_async_engine(DATABASE_URL)
+
+    @event.listens_for(engine.sync_engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.execute("PRAGMA mmap_size=268435456")
+        cursor.close()
+else:
+    engine = create_async_engine(DATABASE_URL, pool_size=20, max_overflow=40, pool_pre_ping=True, pool_recycle=3600)
+SessionLocal = async_sessionmaker(engine, autoflush=False, expire_on_commit=False)
 Base = declarative_base()
 
+def _ensure_favorite_uniqueness(conn):
+    """Back-fill uq_fav_owner_date on favorites tables created before the constraint existed."""
+    inspector = inspect(conn)
+    names = {c["name"] for c in inspector.get_unique_constraints("favorites")}
+    names |= {i["name"] for i in inspector.get_indexes("favorites")}
+    if "uq_fav_owner_date" in names:
+        return
+    conn.execute(text(
+        "DELETE FROM favorites WHERE id NOT IN "
+        "(SELECT MIN(id) FROM favorites GROUP BY owner_id, apod_date)"
+    ))
+    conn.execute(text("CREATE UNIQUE INDEX IF NOT EXISTS uq_fav_owner_date ON favorites (owner_id, apod_date)"))
+
+def _migrate(conn):
+    Base.metadata.create_all(conn)
+    _ensure_favorite_uniqueness(conn)
+
+async def create_schema():
+    """Create missing tables and constraints, tolerating sibling workers doing the same at the same moment."""
+    try:
+        async with engine.begin() as conn:
+            await conn.run_sync(_migrate)
+    except DatabaseError as e:
+        if "already exists" not in str(e):
+            raise
+        # Another worker won the check-then-CREATE race; create whatever it has not yet
+        async with engine.begin() as conn:
+            await conn.run_sync(_migrate)
+
 class User(Base):
     __tablename__ = "users"
 
@@ -21,9 +79,16 @@ class User(Base):
 
 class Favorite(Base):
     __tablename__ = "favorites"
+    __table_args__ = (UniqueConstraint("owner_id", "apod_date", name="uq_fav_owner_date"),)
 
     id = Column(Integer, primary_key=True, index=True)
-    apod_date = Column(Date, index=True)
+    apod_date = Column(Date)
     owner_id = Column(Integer, ForeignKey("users.id"))
 
-    owner = relationship("User", back_populates="favorites")
+    owner = relationship("User", back_populates="favorites", lazy="selectin")
+
+class ApodCache(Base):
+    __tablename__ = "apod_cache"
+
+    apod_date = Column(Date, primary_key=True)
+    payload = Column(JSON)
@@ -1,120 +1,269 @@
 import os
 import httpx
 import asyncio
+import hashlib
 import logging
+import queue
+import atexit
+from logging.handlers import QueueHandler, QueueListener
+import orjson
+import jinja2
+import stat
+import mimetypes
+from anyio import to_thread
 from contextlib import asynccontextmanager
-from fastapi import FastAPI, Request, Depends, Form, HTTPException, Response
+from fastapi import FastAPI, Request, Depends, Form, HTTPException, Query, Response
 from fastapi.templating import Jinja2Templates
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import RedirectResponse
-from sqlalchemy.orm import Session
-from datetime import datetime, timedelta
-from database import SessionLocal, User, Favorite, engine, Base
-from auth import get_password_hash, verify_password, create_access_token, get_current_user
+from fastapi.responses import ORJSONResponse, RedirectResponse
+from sqlalchemy import delete, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import AsyncSession
+from datetime import date, datetime, timedelta
+from cache import ResponseCache, REDIS_URL, is_fresh
+from database import SessionLocal, User, Favorite, ApodCache, engine, create_schema
+from auth import get_password_hash, verify_password, password_needs_rehash, create_access_token, resolve_user, forget_user
 from dotenv import load_dotenv
 from starlette_prometheus import metrics, PrometheusMiddleware
+from starlette.datastructures import Headers
+from brotli_asgi import BrotliMiddleware
 
 load_dotenv()
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('app.log'),
-        logging.StreamHandler()
-    ]
-)
+NASA_API_KEY = os.getenv("NASA_API_KEY", "DEMO_KEY")
+NASA_API_BASE_URL = "https://api.nasa.gov"
+NASA_APOD_PATH = "/planetary/apod"
+# Upper bound on concurrent NASA requests issued while rendering /favorites
+NASA_MAX_CONCURRENCY = 10
+# Today's APOD may still be edited, past entries are effectively immutable
+APOD_TODAY_TTL = 300
+APOD_PAST_TTL = 86400
+
+# Configure logging: handlers enqueue records and a listener thread formats and writes them
+log_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+log_handlers = [logging.FileHandler('app.log'), logging.StreamHandler()]
+for handler in log_handlers:
+    handler.setFormatter(log_formatter)
+log_queue = queue.SimpleQueue()
+log_listener = QueueListener(log_queue, *log_handlers, respect_handler_level=True)
+log_listener.start()
+atexit.register(log_listener.stop)
+queue_handler = QueueHandler(log_queue)
+queue_handler.setFormatter(logging.Formatter('%(message)s'))
+logging.basicConfig(level=logging.INFO, handlers=[queue_handler])
 logger = logging.getLogger(__name__)
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     logger.info("Application startup: Creating data directory and database tables")
     os.makedirs("data", exist_ok=True)
-    Base.metadata.create_all(bind=engine)
+    await create_schema()
     logger.info("Database tables created successfully")
+    app.state.http = httpx.AsyncClient(
+        base_url=NASA_API_BASE_URL,
+        params={"api_key": NASA_API_KEY},
+        http2=True,
+        timeout=10.0,
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+    )
+    app.state.cache = ResponseCache(REDIS_URL)
+    for name in templates.env.list_templates():
+        templates.env.get_template(name)
     yield
     logger.info("Application shutdown")
-    # Clean up resources on shutdown if needed
+    await app.state.http.aclose()
+    await app.state.cache.close()
+    await engine.dispose()
 
-app = FastAPI(lifespan=lifespan)
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 app.add_middleware(PrometheusMiddleware)
+app.add_middleware(BrotliMiddleware, quality=4, minimum_size=1024)
 app.add_route("/metrics", metrics)
-templates = Jinja2Templates(directory="templates")
-app.mount("/static", StaticFiles(directory="static"), name="static")
+os.makedirs(".jinja_cache", exist_ok=True)
+templates = Jinja2Templates(env=jinja2.Environment(
+    loader=jinja2.FileSystemLoader("templates"),
+    autoescape=jinja2.select_autoescape(),
+    auto_reload=False,
+    # Cached bytecode bakes in the autoescape setting, so it gets its own file names
+    bytecode_cache=jinja2.FileSystemBytecodeCache(".jinja_cache", "__jinja2_%s.autoescape.cache"),
+    cache_size=400,
+))
+
+def accepts_brotli(accept_encoding: str) -> bool:
+    """Whether an Accept-Encoding header allows ``br``, honouring q-values and the ``*`` wildcard."""
+    qualities = {}
+    for item in accept_encoding.split(","):
+        coding, _, params = item.partition(";")
+        quality = 1.0
+        for param in params.split(";"):
+            name, _, value = param.strip().partition("=")
+            if name.lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[coding.strip().lower()] = quality
+    return qualities.get("br", qualities.get("*", 0.0)) > 0
+
+class PrecompressedStaticFiles(StaticFiles):
+    """StaticFiles that serves a pre-built ``.br`` sibling when the client accepts Brotli."""
+
+    async def get_response(self, path: str, scope):
+        full_path, stat_result = await to_thread.run_sync(self.lookup_path, path + ".br")
+        if not (stat_result and stat.S_ISREG(stat_result.st_mode)):
+            return await super().get_response(path, scope)
+
+        if accepts_brotli(Headers(scope=scope).get("accept-encoding", "")):
+            # file_response answers If-None-Match/If-Modified-Since with a bare 304
+            response = self.file_response(full_path, stat_result, scope)
+            if response.status_code != 304:
+                response.headers["Content-Type"] = mimetypes.guess_type(path)[0] or "application/octet-stream"
+                response.headers["Content-Encoding"] = "br"
+        else:
+            response = await super().get_response(path, scope)
+        # Both representations live at one URL, so every answer for it (304s included) varies
+        response.headers["Vary"] = "Accept-Encoding"
+        return response
 
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+app.mount("/static", PrecompressedStaticFiles(directory="static"), name="static")
 
-async def get_nasa_apod_data(date: str = None):
-    api_key = os.getenv("NASA_API_KEY", "DEMO_KEY")
-    url = f"https://api.nasa.gov/planetary/apod?api_key={api_key}"
-    if date:
-        url += f"&date={date}"
+async def get_db():
+    async with SessionLocal() as db:
+        yield db
 
-    logger.info(f"Fetching NASA APOD data for date: {date if date else 'today'}")
-    async with httpx.AsyncClient() as client:
-        try:
-            response = await client.get(url)
-            response.raise_for_status()
-            logger.info(f"Successfully fetched NASA APOD data for date: {date if date else 'today'}")
-            return response.json()
-        except httpx.HTTPStatusError as e:
-            logger.error(f"HTTP error fetching NASA APOD data: {e.response.status_code} - {e}")
-            raise
-        except Exception as e:
-            logger.error(f"Unexpected error fetching NASA APOD data: {e}")
-            raise
+def parse_apod_date(value: str) -> date:
+    """Parse a strict ``YYYY-MM-DD`` date; ``fromisoformat`` alone also takes ``20250704`` and week dates."""
+    if len(value) != 10 or value[4] != "-" or value[7] != "-":
+        raise ValueError(f"Invalid date: {value!r}")
+    return date.fromisoformat(value)
+
+def neighbors(d: date) -> tuple[str, str]:
+    """Return the ISO dates of the days before and after ``d``."""
+    ordinal = d.toordinal()
+    return date.fromordinal(ordinal - 1).isoformat(), date.fromordinal(ordinal + 1).isoformat()
+
+async def store_apod(db: AsyncSession, apod_date: date, payload: dict):
+    """Upsert an APOD payload so concurrent first views of a date cannot collide on the primary key."""
+    dialect = postgresql if db.get_bind().dialect.name == "postgresql" else sqlite
+    stmt = dialect.insert(ApodCache).values(apod_date=apod_date, payload=payload)
+    await db.execute(stmt.on_conflict_do_update(
+        index_elements=[ApodCache.apod_date],
+        set_={"payload": stmt.excluded.payload},
+    ))
+
+async def get_nasa_apod_data(date_str: str, client: httpx.AsyncClient, cache: ResponseCache | None = None):
+    today = datetime.utcnow().date().isoformat()
+    key = f"apod:{date_str or today}"
+    ttl = APOD_TODAY_TTL if key == f"apod:{today}" else APOD_PAST_TTL
+    cached = await cache.get(key) if cache else None
+    if is_fresh(cached):
+        return cached["payload"]
+
+    params = {"date": date_str} if date_str else {}
+    # Revalidate a stale entry so an unchanged APOD comes back as a bodiless 304
+    headers = {}
+    if cached and cached.get("etag"):
+        headers["If-None-Match"] = cached["etag"]
+    if cached and cached.get("last_modified"):
+        headers["If-Modified-Since"] = cached["last_modified"]
+
+    logger.info(f"Fetching NASA APOD data for date: {date_str if date_str else 'today'}")
+    try:
+        response = await client.get(NASA_APOD_PATH, params=params, headers=headers)
+        if response.status_code == 304 and cached:
+            logger.info(f"NASA APOD data not modified for date: {date_str if date_str else 'today'}")
+            await cache.set(key, cached["payload"], ttl, cached["etag"], cached["last_modified"])
+            return cached["payload"]
+        response.raise_for_status()
+        logger.info(f"Successfully fetched NASA APOD data for date: {date_str if date_str else 'today'}")
+        data = orjson.loads(response.content)
+    except httpx.HTTPStatusError as e:
+        logger.error(f"HTTP error fetching NASA APOD data: {e.response.status_code} - {e}")
+        raise
+    except httpx.RequestError as e:
+        if cached:
+            logger.warning(f"NASA API unreachable, serving stale APOD data for {key}: {e}")
+            return cached["payload"]
+        logger.error(f"Request error fetching NASA APOD data: {e}")
+        raise
+    except Exception as e:
+        logger.error(f"Unexpected error fetching NASA APOD data: {e}")
+        raise
+
+    if cache:
+        await cache.set(key, data, ttl, response.headers.get("ETag"), response.headers.get("Last-Modified"))
+    return data
 
 @app.get("/")
-async def read_root(request: Request, date: str = None, db: Session = Depends(get_db)):
+async def read_root(request: Request, date_str: str = Query(None, alias="date"), db: AsyncSession = Depends(get_db)):
+    today = datetime.utcnow().date()
     try:
         user = None
         try:
             token = request.cookies.get("access_token")
             if token:
-                user = get_current_user(token.split(" ")[1], db)
+                user = await resolve_user(token, db)
         except Exception:
             pass
 
-        if date:
+        if date_str:
             try:
-                current_date = datetime.strptime(date, "%Y-%m-%d").date()
+                current_date = parse_apod_date(date_str)
             except ValueError:
                 return templates.TemplateResponse("index.html", {"request": request, "error": "Invalid date format. Please use YYYY-MM-DD."})
         else:
-            current_date = datetime.utcnow().date()
+            current_date = today
 
+        current_date_str = current_date.isoformat()
         try:
-            apod_data = await get_nasa_apod_data(current_date.strftime("%Y-%m-%d"))
+            apod_data = await get_nasa_apod_data(current_date_str, request.app.state.http, request.app.state.cache)
         except httpx.HTTPStatusError as e:
             if e.response.status_code == 404:
-                return templates.TemplateResponse("index.html", {"request": request, "error": f"No APOD found for {current_date.strftime('%Y-%m-%d')}."})
+                return templates.TemplateResponse("index.html", {"request": request, "error": f"No APOD found for {current_date_str}."})
             else:
                 raise e
 
-        prev_date = (current_date - timedelta(days=1)).strftime("%Y-%m-%d")
-        next_date = (current_date + timedelta(days=1)).strftime("%Y-%m-%d")
+        cached_row = await db.get(ApodCache, current_date)
+        if cached_row is None or cached_row.payload != apod_data:
+            await store_apod(db, current_date, apod_data)
+            await db.commit()
+
+        prev_date, next_date = neighbors(current_date)
 
         is_favorite = False
         if user:
-            favorite = db.query(Favorite).filter_by(owner_id=user.id, apod_date=current_date).first()
-            if favorite:
-                is_favorite = True
+            is_favorite = bool(await db.scalar(
+                select(Favorite.id).where(Favorite.owner_id == user.id, Favorite.apod_date == current_date).limit(1)
+            ))
+
+        etag = 'W/"' + hashlib.sha1(
+            f"{current_date_str}|{user.id if user else 0}|{is_favorite}|".encode() + orjson.dumps(apod_data)
+        ).hexdigest() + '"'
+        if user:
+            # The favorite button changes without the URL changing, so always revalidate
+            cache_control = "private, no-cache"
+        elif not date_str or current_date >= today:
+            # The undated URL always shows whatever today is
+            cache_control = f"public, max-age={APOD_TODAY_TTL}"
+        else:
+            cache_control = "public, max-age=31536000, immutable"
+        cache_headers = {"ETag": etag, "Cache-Control": cache_control, "Vary": "Cookie"}
+
+        if etag in (tag.strip() for tag in request.headers.get("if-none-match", "").split(",")):
+            return Response(status_code=304, headers=cache_headers)
 
-        return templates.TemplateResponse("index.html", {
+        response = templates.TemplateResponse("index.html", {
             "request": request,
             "apod_data": apod_data,
-            "date": current_date.strftime("%Y-%m-%d"),
+            "date": current_date_str,
             "prev_date": prev_date,
             "next_date": next_date,
             "user": user,
             "is_favorite": is_favorite
         })
+        response.headers.update(cache_headers)
+        return response
     except httpx.RequestError as e:
         return templates.TemplateResponse("index.html", {"request": request, "error": str(e)})
 
@@ -123,18 +272,19 @@ async def signup_form(request: Request):
     return templates.TemplateResponse("signup.html", {"request": request})
 
 @app.post("/signup")
-async def signup(request: Request, username: str = Form(...), password: str = Form(...), db: Session = Depends(get_db)):
+async def signup(request: Request, username: str = Form(...), password: str = Form(...), db: AsyncSession = Depends(get_db)):
     logger.info(f"User signup attempt for username: {username}")
-    user = db.query(User).filter(User.username == username).first()
+    result = await db.execute(select(User).where(User.username == username))
+    user = result.scalar_one_or_none()
     if user:
         logger.warning(f"Signup failed - username already exists: {username}")
         return templates.TemplateResponse("signup.html", {"request": request, "error": "Username already exists"})
 
-    hashed_password = get_password_hash(password)
+    hashed_password = await asyncio.to_thread(get_password_hash, password)
     new_user = User(username=username, hashed_password=hashed_password)
     db.add(new_user)
-    db.commit()
-    db.refresh(new_user)
+    await db.commit()
+    await db.refresh(new_user)
     logger.info(f"New user created successfully: {username}")
 
     return RedirectResponse(url="/login", status_code=303)
@@ -144,13 +294,18 @@ async def login_form(request: Request):
     return templates.TemplateResponse("login.html", {"request": request})
 
 @app.post("/login")
-async def login(response: Response, request: Request, username: str = Form(...), password: str = Form(...), db: Session = Depends(get_db)):
+async def login(response: Response, request: Request, username: str = Form(...), password: str = Form(...), db: AsyncSession = Depends(get_db)):
     logger.info(f"Login attempt for username: {username}")
-    user = db.query(User).filter(User.username == username).first()
-    if not user or not verify_password(password, user.hashed_password):
+    result = await db.execute(select(User).where(User.username == username))
+    user = result.scalar_one_or_none()
+    if not user or not await asyncio.to_thread(verify_password, password, user.hashed_password):
         logger.warning(f"Failed login attempt for username: {username}")
         return templates.TemplateResponse("login.html", {"request": request, "error": "Invalid username or password"})
 
+    if password_needs_rehash(user.hashed_password):
+        user.hashed_password = await asyncio.to_thread(get_password_hash, password)
+        await db.commit()
+
     access_token_expires = timedelta(minutes=30)
     access_token = create_access_token(
         data={"sub": user.username}, expires_delta=access_token_expires
@@ -161,61 +316,94 @@ async def login(response: Response, request: Request, username: str = Form(...),
     return response
 
 @app.get("/logout")
-async def logout(response: Response):
+async def logout(request: Request, response: Response):
     logger.info("User logout")
+    token = request.cookies.get("access_token")
+    if token:
+        forget_user(token)
     response = RedirectResponse(url="/", status_code=303)
     response.delete_cookie("access_token")
     return response
 
 @app.post("/favorite")
-async def add_favorite(request: Request, apod_date: str = Form(...), db: Session = Depends(get_db)):
+async def add_favorite(request: Request, apod_date: str = Form(...), db: AsyncSession = Depends(get_db)):
     token = request.cookies.get("access_token")
     if not token:
         return RedirectResponse(url="/login", status_code=303)
 
-    user = get_current_user(token.split(" ")[1], db)
-    date_obj = datetime.strptime(apod_date, "%Y-%m-%d").date()
+    user = await resolve_user(token, db)
+    try:
+        date_obj = parse_apod_date(apod_date)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid date format. Please use YYYY-MM-DD.")
 
-    favorite = db.query(Favorite).filter_by(owner_id=user.id, apod_date=date_obj).first()
-    if favorite:
-        db.delete(favorite)
-        db.commit()
+    favorite_id = await db.scalar(
+        select(Favorite.id).where(Favorite.owner_id == user.id, Favorite.apod_date == date_obj).limit(1)
+    )
+    if favorite_id:
+        await db.execute(delete(Favorite).where(Favorite.id == favorite_id))
+        await db.commit()
     else:
         new_favorite = Favorite(apod_date=date_obj, owner_id=user.id)
         db.add(new_favorite)
-        db.commit()
+        try:
+            await db.commit()
+        except IntegrityError:
+            # A concurrent request already favorited this date
+            await db.rollback()
 
-    return RedirectResponse(url=f"/?date={apod_date}", status_code=303)
+    return RedirectResponse(url=f"/?date={date_obj.isoformat()}", status_code=303)
 
 @app.get("/favorites")
-async def favorites(request: Request, db: Session = Depends(get_db)):
+async def favorites(request: Request, db: AsyncSession = Depends(get_db)):
     token = request.cookies.get("access_token")
     if not token:
         return RedirectResponse(url="/login", status_code=303)
 
-    user = get_current_user(token.split(" ")[1], db)
-    favorites = db.query(Favorite).filter_by(owner_id=user.id).all()
+    user = await resolve_user(token, db)
+    result = await db.execute(
+        select(Favorite.apod_date, ApodCache.payload)
+        .outerjoin(ApodCache, Favorite.apod_date == ApodCache.apod_date)
+        .where(Favorite.owner_id == user.id)
+        .order_by(Favorite.apod_date.desc())
+    )
+    rows = result.all()
+    missing = [apod_date for apod_date, payload in rows if payload is None]
 
-    logger.info(f"Fetching {len(favorites)} favorite APOD entries for user: {user.username}")
-    async with httpx.AsyncClient() as client:
-        tasks = []
-        for fav in favorites:
-            date_str = fav.apod_date.strftime("%Y-%m-%d")
-            api_key = os.getenv("NASA_API_KEY", "DEMO_KEY")
-            url = f"https://api.nasa.gov/planetary/apod?api_key={api_key}&date={date_str}"
-            tasks.append(client.get(url))
+    logger.info(f"Fetching {len(missing)} of {len(rows)} favorite APOD entries for user: {user.username}")
+    client = request.app.state.http
+    sem = asyncio.Semaphore(NASA_MAX_CONCURRENCY)
 
-        try:
-            responses = await asyncio.gather(*tasks)
-            logger.info(f"Successfully fetched all {len(responses)} favorite APOD entries")
-        except Exception as e:
-            logger.error(f"Error fetching favorite APOD entries: {e}")
-            raise
+    async def fetch(date_str: str):
+        async with sem:
+            return await client.get(NASA_APOD_PATH, params={"date": date_str})
+
+    try:
+        responses = await asyncio.gather(*(fetch(d.isoformat()) for d in missing))
+        logger.info(f"Successfully fetched all {len(responses)} favorite APOD entries")
+    except Exception as e:
+        logger.error(f"Error fetching favorite APOD entries: {e}")
+        raise
+
+    fetched = {}
+    for apod_date, res in zip(missing, responses):
+        fetched[apod_date] = orjson.loads(res.content)
+        if res.is_success:
+            await store_apod(db, apod_date, fetched[apod_date])
+    await db.commit()
 
-    apods = [res.json() for res in responses]
+    apods = [payload if payload is not None else fetched[apod_date] for apod_date, payload in rows]
 
     return templates.TemplateResponse("favorites.html", {"request": request, "apods": apods, "user": user})
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8000,
+        loop="uvloop",
+        http="httptools",
+        workers=os.cpu_count() or 2,
+        proxy_headers=True,
+    )
\ No newline at end of file
@@ -0,0 +1,165 @@
+import os
+from contextvars import ContextVar
+
+# Keep the app's own engine off data/test.db so parallel workers never share a file
+os.environ.setdefault("DATABASE_URL", "sqlite+aiosqlite://")
+
+import httpx
+import pytest
+import pytest_asyncio
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine, async_sessionmaker
+from sqlalchemy.pool import StaticPool
+from passlib.context import CryptContext
+
+import auth
+import main
+from database import Base
+from auth import _user_cache
+
+# Each pytest-xdist worker is its own process, so in-memory databases never collide
+SQLALCHEMY_DATABASE_URL = "sqlite+aiosqlite://"
+
+# Let SQLAlchemy emit BEGIN itself so SAVEPOINTs nest inside the per-test transaction
+def _disable_driver_transactions(dbapi_connection, connection_record):
+    dbapi_connection.isolation_level = None
+
+def _emit_begin(conn):
+    conn.exec_driver_sql("BEGIN")
+
+# The test database is throwaway, so skip durability work on every write
+def _fast_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA synchronous=OFF")
+    cursor.execute("PRAGMA journal_mode=MEMORY")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.close()
+
+TestingSessionLocal = async_sessionmaker(autoflush=False, expire_on_commit=False)
+
+# Session shared by every request of the running test, bound to its outer transaction
+_test_session: ContextVar[AsyncSession | None] = ContextVar("test_session", default=None)
+
+# Override the get_db dependency for the app
+async def override_get_db():
+    session = _test_session.get()
+    if session is not None:
+        yield session
+    else:
+        async with TestingSessionLocal() as db:
+            yield db
+
+main.app.dependency_overrides[main.get_db] = override_get_db
+
+# Canned NASA APOD payloads keyed by ISO date; the None key answers any other date.
+# An exception instance is raised instead of returned.
+FAKE_RESPONSES = {}
+
+async def _fake_get_nasa_apod_data(date_str, client=None, cache=None):
+    response = FAKE_RESPONSES[date_str] if date_str in FAKE_RESPONSES else FAKE_RESPONSES[None]
+    if isinstance(response, Exception):
+        raise response
+    return response
+
+@pytest.fixture(scope="session", autouse=True)
+def _stub_nasa_api():
+    """Replace the NASA APOD call with a lookup in FAKE_RESPONSES for the whole session."""
+    original = main.get_nasa_apod_data
+    main.get_nasa_apod_data = _fake_get_nasa_apod_data
+    yield
+    main.get_nasa_apod_data = original
+
+@pytest.fixture
+def fake_apod():
+    """The FAKE_RESPONSES table, emptied again after the test."""
+    yield FAKE_RESPONSES
+    FAKE_RESPONSES.clear()
+
+@pytest.fixture(scope="session", autouse=True)
+def _fast_password_hashing():
+    """Hash test passwords at the lowest argon2/bcrypt cost; production settings are untouched."""
+    original = auth.pwd_context
+    auth.pwd_context = CryptContext(
+        schemes=["argon2", "bcrypt"],
+        deprecated="auto",
+        argon2__time_cost=1,
+        argon2__memory_cost=8,
+        argon2__parallelism=1,
+        bcrypt__rounds=4,
+    )
+    yield
+    auth.pwd_context = original
+
+@pytest.fixture(scope="session", autouse=True)
+def _memoized_password_hashing(_fast_password_hashing):
+    """Hash each test password once and reuse the result for every later signup and login."""
+    hashes, verified = {}, {}
+    original_hash, original_verify = main.get_password_hash, main.verify_password
+
+    def get_password_hash(password):
+        if password not in hashes:
+            hashes[password] = original_hash(password)
+        return hashes[password]
+
+    def verify_password(plain_password, hashed_password):
+        key = (plain_password, hashed_password)
+        if key not in verified:
+            verified[key] = original_verify(plain_password, hashed_password)
+        return verified[key]
+
+    main.get_password_hash, main.verify_password = get_password_hash, verify_password
+    yield
+    main.get_password_hash, main.verify_password = original_hash, original_verify
+
+@pytest_asyncio.fixture(scope="session")
+async def engine():
+    """The test database engine, private to this worker process."""
+    engine = create_async_engine(
+        SQLALCHEMY_DATABASE_URL,
+        poolclass=StaticPool,  # Use StaticPool to ensure all sessions use the same connection
+    )
+    event.listen(engine.sync_engine, "connect", _disable_driver_transactions)
+    event.listen(engine.sync_engine, "connect", _fast_pragmas)
+    event.listen(engine.sync_engine, "begin", _emit_begin)
+    TestingSessionLocal.configure(bind=engine)
+    yield engine
+    await engine.dispose()
+
+@pytest.fixture(scope="session")
+def session_factory(engine):
+    """Session factory bound to the test engine, for setup that must outlive a single test."""
+    return TestingSessionLocal
+
+@pytest_asyncio.fixture(scope="session")
+async def _schema(engine):
+    """Create the database tables once for the whole test session."""
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+
+@pytest_asyncio.fixture(scope="function")
+async def db_setup_and_teardown(engine, _schema):
+    """Run each test inside a transaction that is rolled back afterwards for isolation."""
+    connection = await engine.connect()
+    trans = await connection.begin()
+    # Commits made by the app only release a SAVEPOINT inside the outer transaction
+    session = TestingSessionLocal(bind=connection, join_transaction_mode="create_savepoint")
+    token = _test_session.set(session)
+    yield session
+    _test_session.reset(token)
+    await session.close()
+    await trans.rollback()
+    await connection.close()
+    _user_cache.clear()
+
+@pytest.fixture(scope="session")
+def app():
+    """The FastAPI application, with the test database dependency installed."""
+    return main.app
+
+@pytest_asyncio.fixture(scope="session")
+async def client(app):
+    """An async client dispatching straight into the app, with its lifespan running."""
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://testserver") as c:
+            yield c
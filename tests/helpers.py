@@ -0,0 +1,7 @@
+"""Assertion helpers shared by the test modules."""
+
+def assert_contains(response, *needles):
+    """Decode the response body once and check that it contains every needle."""
+    text = response.text
+    missing = [needle for needle in needles if needle not in text]
+    assert not missing, f"Missing from response body: {missing}"
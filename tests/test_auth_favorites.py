@@ -1,110 +1,171 @@
 import pytest
-from fastapi.testclient import TestClient
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy.pool import StaticPool
-from unittest.mock import patch, AsyncMock
-import asyncio
-
-from main import app, get_db
-from database import Base, User
-from auth import get_password_hash
-
-# Setup a shared in-memory SQLite database for testing
-SQLALCHEMY_DATABASE_URL = "sqlite://"
-
-engine = create_engine(
-    SQLALCHEMY_DATABASE_URL,
-    connect_args={"check_same_thread": False},
-    poolclass=StaticPool,  # Use StaticPool to ensure all sessions use the same connection
-)
-TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-
-# Override the get_db dependency for the app
-def override_get_db():
-    db = TestingSessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
-
-app.dependency_overrides[get_db] = override_get_db
-
-@pytest.fixture(scope="function")
-def db_setup_and_teardown():
-    """Create and drop database tables for each test function for isolation."""
-    Base.metadata.create_all(bind=engine)
-    yield
-    Base.metadata.drop_all(bind=engine)
-
-@pytest.fixture(scope="module")
-def client():
-    """A TestClient that uses the overridden database dependency."""
-    return TestClient(app)
+import pytest_asyncio
+from datetime import date
+from types import SimpleNamespace
+from passlib.hash import bcrypt
+from sqlalchemy import func, select
+
+import auth
+from auth import _user_cache
+from database import Favorite, User
+from helpers import assert_contains
+
+TEST_PASSWORD = "favpass"
+
+_APOD_JULY1 = {"title": "July 1st APOD", "date": "2025-07-01", "media_type": "image", "url": "", "explanation": ""}
+_APOD_DEFAULT = {"title": "Default APOD", "date": "2025-07-06", "media_type": "image", "url": "", "explanation": ""}
 
 @pytest.fixture
-def mock_nasa_api():
+def mock_nasa_api(fake_apod):
     """Mock the NASA APOD API call."""
-    with patch('main.get_nasa_apod_data', new_callable=AsyncMock) as mock_get:
-        async def side_effect(date=None):
-            if date == "2025-07-01":
-                return {"title": "July 1st APOD", "date": "2025-07-01", "media_type": "image", "url": "", "explanation": ""}
-            return {"title": "Default APOD", "date": "2025-07-06", "media_type": "image", "url": "", "explanation": ""}
-        mock_get.side_effect = side_effect
-        yield
+    fake_apod["2025-07-01"] = _APOD_JULY1
+    fake_apod[None] = _APOD_DEFAULT
+    return fake_apod
 
 # --- Auth Tests ---
-def test_signup_and_login(client, db_setup_and_teardown):
+@pytest.mark.asyncio
+async def test_signup_and_login(client, db_setup_and_teardown):
     # Sign up a new user and don't follow the redirect
-    response = client.post("/signup", data={"username": "testuser", "password": "testpass"}, follow_redirects=False)
+    response = await client.post("/signup", data={"username": "testuser", "password": "testpass"}, follow_redirects=False)
     assert response.status_code == 303
     assert response.headers["location"] == "/login"
 
     # Log in with the new user and don't follow the redirect
-    response = client.post("/login", data={"username": "testuser", "password": "testpass"}, follow_redirects=False)
+    response = await client.post("/login", data={"username": "testuser", "password": "testpass"}, follow_redirects=False)
     assert response.status_code == 303
     assert "access_token" in response.cookies
 
+@pytest.mark.asyncio
+async def test_login_rejects_wrong_password(client, make_user):
+    username = await make_user("loginuser")
+    response = await client.post("/login", data={"username": username, "password": "wrong"}, follow_redirects=False)
+    assert response.status_code == 200
+    assert "Invalid username or password" in response.text
+    assert "access_token" not in response.cookies
+
+@pytest.mark.asyncio
+async def test_login_upgrades_bcrypt_hash(client, db_setup_and_teardown, make_user):
+    username = await make_user("legacyuser", bcrypt.using(rounds=4).hash(TEST_PASSWORD))
+    response = await client.post("/login", data={"username": username, "password": TEST_PASSWORD}, follow_redirects=False)
+    assert response.status_code == 303
+    stored = await db_setup_and_teardown.scalar(select(User.hashed_password).where(User.username == username))
+    assert stored.startswith("$argon2id$")
+
 # --- Go to Date Test ---
-def test_go_to_date(client, db_setup_and_teardown, mock_nasa_api):
-    response = client.get("/?date=2025-07-01")
+@pytest.mark.asyncio
+async def test_go_to_date(client, db_setup_and_teardown, mock_nasa_api):
+    response = await client.get("/?date=2025-07-01")
     assert response.status_code == 200
     assert "July 1st APOD" in response.text
 
 # --- Favorites Tests ---
+@pytest.fixture(scope="session")
+def password_hash():
+    """One hash of TEST_PASSWORD shared by every user the tests insert directly."""
+    return auth.get_password_hash(TEST_PASSWORD)
+
+async def _insert_user(db, username, hashed_password):
+    """Insert a user straight into the database, bypassing the signup endpoint."""
+    db.add(User(username=username, hashed_password=hashed_password))
+    await db.commit()
+    return username
+
+@pytest.fixture
+def make_user(db_setup_and_teardown, password_hash):
+    """Insert users into the per-test transaction."""
+    async def _make_user(username="u", hashed_password=None):
+        return await _insert_user(db_setup_and_teardown, username, hashed_password or password_hash)
+    return _make_user
+
+@pytest_asyncio.fixture(scope="session")
+async def auth_cookie(client, _schema, session_factory, password_hash):
+    """Create and log in 'favuser' once, outside any per-test transaction."""
+    async with session_factory() as db:
+        await _insert_user(db, "favuser", password_hash)
+    response = await client.post("/login", data={"username": "favuser", "password": TEST_PASSWORD}, follow_redirects=False)
+    client.cookies.clear()
+    return response.cookies["access_token"]
+
 @pytest.fixture
-def authenticated_client(client, db_setup_and_teardown):
+def authenticated_client(client, auth_cookie, db_setup_and_teardown):
     """Return a client that is authenticated as 'favuser'."""
-    client.post("/signup", data={"username": "favuser", "password": "favpass"}, follow_redirects=True)
-    client.post("/login", data={"username": "favuser", "password": "favpass"}, follow_redirects=True)
-    return client
+    client.cookies.set("access_token", auth_cookie)
+    yield client
+    client.cookies.clear()
+
+async def _favorite_count(db, apod_date):
+    return await db.scalar(
+        select(func.count())
+        .select_from(Favorite)
+        .join(User, Favorite.owner_id == User.id)
+        .where(User.username == "favuser", Favorite.apod_date == apod_date)
+    )
+
+@pytest.mark.asyncio
+async def test_add_and_remove_favorite(authenticated_client, db_setup_and_teardown, mock_nasa_api):
+    db = db_setup_and_teardown
 
-def test_add_and_remove_favorite(authenticated_client, mock_nasa_api):
     # Add a favorite
-    response = authenticated_client.post("/favorite", data={"apod_date": "2025-07-06"}, follow_redirects=False)
+    response = await authenticated_client.post("/favorite", data={"apod_date": "2025-07-06"}, follow_redirects=False)
     assert response.status_code == 303
+    assert await _favorite_count(db, date(2025, 7, 6)) == 1
 
-    # Check if it's favorited by following the redirect
-    response = authenticated_client.get("/?date=2025-07-06")
+    # The page reflects it
+    response = await authenticated_client.get("/?date=2025-07-06")
     assert "Unfavorite" in response.text
 
     # Remove the favorite
-    response = authenticated_client.post("/favorite", data={"apod_date": "2025-07-06"}, follow_redirects=False)
+    response = await authenticated_client.post("/favorite", data={"apod_date": "2025-07-06"}, follow_redirects=False)
     assert response.status_code == 303
+    assert await _favorite_count(db, date(2025, 7, 6)) == 0
+
+@pytest.mark.asyncio
+async def test_favorite_rejects_non_canonical_dates(authenticated_client, db_setup_and_teardown):
+    response = await authenticated_client.post("/favorite", data={"apod_date": "20250706"}, follow_redirects=False)
+    assert response.status_code == 400
+    assert await _favorite_count(db_setup_and_teardown, date(2025, 7, 6)) == 0
+
+def fake_gather(results, calls=None):
+    """Build a stand-in for asyncio.gather that discards its coroutines and returns ``results``."""
+    async def gather(*coros, **_):
+        for coro in coros:
+            coro.close()
+        if calls is not None:
+            calls.append(len(coros))
+        return results
+    return gather
+
+@pytest.mark.asyncio
+async def test_view_favorites_page(authenticated_client, mock_nasa_api, monkeypatch):
+    # Add a favorite
+    await authenticated_client.post("/favorite", data={"apod_date": "2025-07-01"}, follow_redirects=True)
 
-    # Check it's no longer a favorite
-    response = authenticated_client.get("/?date=2025-07-06")
-    assert "Favorite" in response.text
+    monkeypatch.setattr("main.asyncio.gather", fake_gather([
+        SimpleNamespace(content=b'{"title": "July 1st APOD"}', is_success=True)
+    ]))
+    response = await authenticated_client.get("/favorites")
+    assert response.status_code == 200
+    assert_contains(response, "My Favorites", "July 1st APOD")
 
-def test_view_favorites_page(authenticated_client, mock_nasa_api):
-    # Add a favorite
-    authenticated_client.post("/favorite", data={"apod_date": "2025-07-01"}, follow_redirects=True)
-
-    with patch('main.asyncio.gather', new_callable=AsyncMock) as mock_gather:
-        mock_gather.return_value = [
-            type('obj', (object,), {'json': lambda: {"title": "July 1st APOD"}})
-        ]
-        response = authenticated_client.get("/favorites")
-        assert response.status_code == 200
-        assert "My Favorites" in response.text
-        assert "July 1st APOD" in response.text
\ No newline at end of file
+@pytest.mark.asyncio
+async def test_favorites_page_uses_stored_apod(authenticated_client, mock_nasa_api, monkeypatch):
+    # Viewing the date stores its APOD locally, so /favorites needs no NASA call
+    await authenticated_client.get("/?date=2025-07-01")
+    await authenticated_client.post("/favorite", data={"apod_date": "2025-07-01"}, follow_redirects=True)
+
+    calls = []
+    monkeypatch.setattr("main.asyncio.gather", fake_gather([], calls))
+    response = await authenticated_client.get("/favorites")
+    assert response.status_code == 200
+    assert "July 1st APOD" in response.text
+    assert calls == [0]
+
+
+@pytest.mark.asyncio
+async def test_logout_forgets_cached_user(authenticated_client, mock_nasa_api):
+    token = authenticated_client.cookies.get("access_token").strip('"')
+    await authenticated_client.get("/?date=2025-07-06")
+    assert token in _user_cache
+
+    await authenticated_client.get("/logout", follow_redirects=False)
+    assert token not in _user_cache
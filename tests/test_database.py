@@ -0,0 +1,62 @@
+import pytest
+from sqlalchemy import inspect, text
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.ext.asyncio import create_async_engine
+
+import database
+from database import Base, create_schema, to_async_url
+
+
+@pytest.mark.parametrize("url, expected", [
+    ("sqlite:///./data/test.db", "sqlite+aiosqlite:///./data/test.db"),
+    ("sqlite+aiosqlite://", "sqlite+aiosqlite://"),
+    ("postgres://u:p@db/apod", "postgresql+asyncpg://u:p@db/apod"),
+    ("postgresql://u:p@db/apod", "postgresql+asyncpg://u:p@db/apod"),
+    ("postgresql+asyncpg://u:p@db/apod", "postgresql+asyncpg://u:p@db/apod"),
+])
+def test_to_async_url(url, expected):
+    assert to_async_url(url).render_as_string(hide_password=False) == expected
+
+
+@pytest.mark.asyncio
+async def test_create_schema_tolerates_a_concurrent_worker(tmp_path, monkeypatch):
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'race.db'}")
+    monkeypatch.setattr(database, "engine", engine)
+    create_all = Base.metadata.create_all
+    calls = []
+
+    def racing_create_all(bind, **kw):
+        calls.append(bind)
+        if len(calls) == 1:
+            # A sibling worker creates the tables between our check and our CREATE
+            create_all(bind, **kw)
+            raise OperationalError("CREATE TABLE users", {}, Exception("table users already exists"))
+        create_all(bind, **kw)
+
+    monkeypatch.setattr(Base.metadata, "create_all", racing_create_all)
+    await create_schema()
+
+    async with engine.connect() as conn:
+        tables = await conn.run_sync(lambda sync_conn: inspect(sync_conn).get_table_names())
+    await engine.dispose()
+    assert len(calls) == 2
+    assert {"users", "favorites", "apod_cache"} <= set(tables)
+
+
+@pytest.mark.asyncio
+async def test_create_schema_adds_favorite_uniqueness_to_old_databases(tmp_path, monkeypatch):
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'old.db'}")
+    monkeypatch.setattr(database, "engine", engine)
+    async with engine.begin() as conn:
+        # favorites as created before uq_fav_owner_date, already holding a duplicate
+        await conn.execute(text("CREATE TABLE favorites (id INTEGER PRIMARY KEY, apod_date DATE, owner_id INTEGER)"))
+        await conn.execute(text("INSERT INTO favorites (apod_date, owner_id) VALUES ('2025-07-04', 1), ('2025-07-04', 1), ('2025-07-05', 1)"))
+
+    await create_schema()
+    await create_schema()
+
+    async with engine.connect() as conn:
+        assert (await conn.scalar(text("SELECT COUNT(*) FROM favorites"))) == 2
+        with pytest.raises(IntegrityError):
+            await conn.execute(text("INSERT INTO favorites (apod_date, owner_id) VALUES ('2025-07-04', 1)"))
+    await engine.dispose()
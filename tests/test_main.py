@@ -1,83 +1,209 @@
+from datetime import date, datetime
+
+import brotli
 import pytest
-from fastapi.testclient import TestClient
-from unittest.mock import patch
-from main import app
+from sqlalchemy import select
+from main import PrecompressedStaticFiles, accepts_brotli, get_nasa_apod_data, store_apod
+from database import ApodCache
+from cache import ResponseCache, is_fresh
+from helpers import assert_contains
 import httpx
 
-client = TestClient(app)
+_APOD_SUCCESS = {
+    "copyright":"Alberto Pisabarro",
+    "date":"2025-07-04",
+    "explanation":"Face-on spiral galaxy NGC 6946 and open star cluster NGC 6939 share this cosmic snapshot...",
+    "hdurl":"https://apod.nasa.gov/apod/image/2507/N6946N6939pisabarro.jpg",
+    "media_type":"image",
+    "service_version":"v1",
+    "title":"NGC 6946 and NGC 6939",
+    "url":"https://apod.nasa.gov/apod/image/2507/N6946N6939pisabarro1024.jpg"
+}
+
+_APOD_VIDEO = {
+    "date": "2025-07-03",
+    "explanation": "This is a video of a black hole.",
+    "media_type": "video",
+    "title": "Black Hole Video",
+    "url": "https://www.youtube.com/watch?v=dQw4w9WgXcQ"
+}
+
+pytestmark = [pytest.mark.asyncio, pytest.mark.usefixtures("db_setup_and_teardown")]
 
 @pytest.fixture
-def mock_nasa_api_success():
-    with patch('main.get_nasa_apod_data') as mock_get:
-        mock_get.return_value = {
-            "copyright":"Alberto Pisabarro",
-            "date":"2025-07-04",
-            "explanation":"Face-on spiral galaxy NGC 6946 and open star cluster NGC 6939 share this cosmic snapshot...",
-            "hdurl":"https://apod.nasa.gov/apod/image/2507/N6946N6939pisabarro.jpg",
-            "media_type":"image",
-            "service_version":"v1",
-            "title":"NGC 6946 and NGC 6939",
-            "url":"https://apod.nasa.gov/apod/image/2507/N6946N6939pisabarro1024.jpg"
-        }
-        yield
+def mock_nasa_api_success(fake_apod):
+    fake_apod[None] = _APOD_SUCCESS
 
 @pytest.fixture
-def mock_nasa_api_failure():
-    with patch('main.get_nasa_apod_data') as mock_get:
-        mock_get.side_effect = httpx.RequestError("Failed to fetch data from NASA API")
-        yield
+def mock_nasa_api_failure(fake_apod):
+    fake_apod[None] = httpx.RequestError("Failed to fetch data from NASA API")
 
-def test_read_root_success(mock_nasa_api_success):
-    response = client.get("/")
+async def test_read_root_success(client, mock_nasa_api_success):
+    response = await client.get("/")
     assert response.status_code == 200
     assert "NGC 6946 and NGC 6939" in response.text
 
-def test_read_root_failure(mock_nasa_api_failure):
-    response = client.get("/")
+async def test_read_root_failure(client, mock_nasa_api_failure):
+    response = await client.get("/")
     assert response.status_code == 200
     assert "Failed to fetch data from NASA API" in response.text
 
 
-def test_read_root_with_date(mock_nasa_api_success):
-    response = client.get("/?date=2025-07-04")
+async def test_read_root_with_date(client, mock_nasa_api_success):
+    response = await client.get("/?date=2025-07-04")
     assert response.status_code == 200
     assert "NGC 6946 and NGC 6939" in response.text
 
 
-def test_date_navigation(mock_nasa_api_success):
-    response = client.get("/?date=2025-07-04")
+async def test_date_navigation(client, mock_nasa_api_success):
+    response = await client.get("/?date=2025-07-04")
     assert response.status_code == 200
-    assert "/?date=2025-07-03" in response.text
-    assert "/?date=2025-07-05" in response.text
+    assert_contains(response, "/?date=2025-07-03", "/?date=2025-07-05")
 
 
-def test_invalid_date_format():
-    response = client.get("/?date=invalid-date")
+@pytest.mark.parametrize("value", ["invalid-date", "20250704", "2025-W27-5", "2025-07-4"])
+async def test_invalid_date_format(client, value):
+    response = await client.get("/", params={"date": value})
     assert response.status_code == 200
     assert "Invalid date format. Please use YYYY-MM-DD." in response.text
 
 
-def test_static_file():
-    response = client.get("/static/styles.css")
+async def test_static_file(client):
+    response = await client.get("/static/styles.css")
     assert response.status_code == 200
     assert "text/css" in response.headers["content-type"]
 
 
+async def test_static_file_precompressed(tmp_path):
+    css = b"body { color: red; }"
+    (tmp_path / "app.css").write_bytes(css)
+    (tmp_path / "app.css.br").write_bytes(brotli.compress(css))
+    transport = httpx.ASGITransport(app=PrecompressedStaticFiles(directory=tmp_path))
+    async with httpx.AsyncClient(transport=transport, base_url="http://testserver") as http:
+        response = await http.get("/app.css", headers={"Accept-Encoding": "br"})
+        assert response.headers["content-encoding"] == "br"
+        assert response.headers["vary"] == "Accept-Encoding"
+        assert "text/css" in response.headers["content-type"]
+        assert response.content == css
+
+        response = await http.get("/app.css", headers={"Accept-Encoding": "br", "If-None-Match": response.headers["etag"]})
+        assert response.status_code == 304
+        assert "content-encoding" not in response.headers
+        assert response.headers["vary"] == "Accept-Encoding"
+
+        response = await http.get("/app.css", headers={"Accept-Encoding": "gzip, br;q=0"})
+        assert "content-encoding" not in response.headers
+        assert response.headers["vary"] == "Accept-Encoding"
+        assert response.content == css
+
+
+@pytest.mark.parametrize("header, expected", [
+    ("gzip, deflate, br", True),
+    ("br;q=0.5", True),
+    ("BR", True),
+    ("*", True),
+    ("", False),
+    ("gzip", False),
+    ("br;q=0", False),
+    ("br;q=0.0, gzip", False),
+    ("*, br;q=0", False),
+    ("*;q=0", False),
+])
+async def test_accepts_brotli(header, expected):
+    assert accepts_brotli(header) is expected
+
+
 @pytest.fixture
-def mock_nasa_api_video():
-    with patch('main.get_nasa_apod_data') as mock_get:
-        mock_get.return_value = {
-            "date": "2025-07-03",
-            "explanation": "This is a video of a black hole.",
-            "media_type": "video",
-            "title": "Black Hole Video",
-            "url": "https://www.youtube.com/watch?v=dQw4w9WgXcQ"
-        }
-        yield
-
-
-def test_read_root_video(mock_nasa_api_video):
-    response = client.get("/?date=2025-07-03")
+def mock_nasa_api_video(fake_apod):
+    fake_apod[None] = _APOD_VIDEO
+
+
+async def test_read_root_video(client, mock_nasa_api_video):
+    response = await client.get("/?date=2025-07-03")
     assert response.status_code == 200
-    assert "Black Hole Video" in response.text
-    assert "video" in response.text
+    assert_contains(response, "Black Hole Video", "video")
+
+
+async def test_get_nasa_apod_data_uses_cache():
+    calls = []
+
+    def handler(request):
+        calls.append(request)
+        return httpx.Response(200, json={"title": "Cached APOD", "date": "2025-07-04"})
+
+    cache = ResponseCache()
+    async with httpx.AsyncClient(transport=httpx.MockTransport(handler), base_url="https://api.nasa.gov") as http:
+        first = await get_nasa_apod_data("2025-07-04", http, cache)
+        second = await get_nasa_apod_data("2025-07-04", http, cache)
+    assert first == second == {"title": "Cached APOD", "date": "2025-07-04"}
+    assert len(calls) == 1
+
+
+async def test_get_nasa_apod_data_serves_stale_on_request_error():
+    def handler(request):
+        raise httpx.ConnectError("NASA is down", request=request)
+
+    cache = ResponseCache()
+    await cache.set("apod:2025-07-04", {"title": "Stale APOD"}, ttl=-1)
+    async with httpx.AsyncClient(transport=httpx.MockTransport(handler), base_url="https://api.nasa.gov") as http:
+        assert await get_nasa_apod_data("2025-07-04", http, cache) == {"title": "Stale APOD"}
+
+
+async def test_get_nasa_apod_data_revalidates_with_etag():
+    seen = []
+
+    def handler(request):
+        seen.append(request.headers.get("If-None-Match"))
+        return httpx.Response(304)
+
+    cache = ResponseCache()
+    await cache.set("apod:2025-07-04", {"title": "Unchanged APOD"}, ttl=-1, etag='"abc"')
+    async with httpx.AsyncClient(transport=httpx.MockTransport(handler), base_url="https://api.nasa.gov") as http:
+        data = await get_nasa_apod_data("2025-07-04", http, cache)
+
+    assert data == {"title": "Unchanged APOD"}
+    assert seen == ['"abc"']
+    assert is_fresh(await cache.get("apod:2025-07-04"))
+
+
+async def test_read_root_conditional_request(client, mock_nasa_api_success):
+    response = await client.get("/?date=2025-07-04")
+    assert response.headers["cache-control"] == "public, max-age=31536000, immutable"
+    etag = response.headers["etag"]
+
+    response = await client.get("/?date=2025-07-04", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.headers["etag"] == etag
+
+
+async def test_read_root_today_is_never_immutable(client, monkeypatch, mock_nasa_api_success):
+    # The request starts just before UTC midnight and finishes after it
+    clock = iter([datetime(2025, 7, 4, 23, 59, 59), datetime(2025, 7, 5, 0, 0, 1)])
+
+    class FakeDatetime(datetime):
+        @classmethod
+        def utcnow(cls):
+            return next(clock)
+
+    monkeypatch.setattr("main.datetime", FakeDatetime)
+    response = await client.get("/")
+    assert response.headers["cache-control"] == "public, max-age=300"
+
+
+async def test_read_root_upserts_apod_cache(client, db_setup_and_teardown, mock_nasa_api_success):
+    db = db_setup_and_teardown
+    # A row written by another worker between this request's lookup and its insert
+    await store_apod(db, date(2025, 7, 4), {"title": "Outdated APOD"})
+
+    response = await client.get("/?date=2025-07-04")
+
+    assert response.status_code == 200
+    payloads = (await db.scalars(select(ApodCache.payload).where(ApodCache.apod_date == date(2025, 7, 4)))).all()
+    assert payloads == [_APOD_SUCCESS]
+
+
+async def test_read_root_escapes_apod_fields(client, fake_apod):
+    fake_apod[None] = {**_APOD_SUCCESS, "title": "<script>alert(1)</script>"}
+    response = await client.get("/?date=2025-07-04")
+    assert "<script>alert(1)</script>" not in response.text
+    assert "&lt;script&gt;alert(1)&lt;/script&gt;" in response.text